@@ -1,11 +1,10 @@
-import pandas as pd
-
 from connectors.ch_connector import ClickHouseConnector
 from connectors.appmetrica_connector import AppMetricaConnector
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from utils import get_logger
-from config import appmetrica_endpoints
+from config import appmetrica_endpoints, appmetrica_fields
 try:
     from dotenv import load_dotenv
     load_dotenv()
@@ -52,30 +51,77 @@ def check_connections():
         connection_errors.append('App Metrica')
 
     if connection_errors:
-        client_ch.disconnect()
         raise ConnectionError(f'Ошибка при подключении к {" и ".join(connection_errors)}')
     return True
 
 def do_app_etl(app_id: int):
     source_names = list(appmetrica_endpoints.keys())
-    for source_name in source_names:
-        logger.info(f'Запускаю получение данных для источника {source_name}')
-        do_source_etl(app_id, source_name)
-        logger.info(f'Успешное получение данных для источника {source_name}')
+    # Источники обрабатываются параллельно: ожидание выгрузки одного источника
+    # не блокирует загрузку другого
+    with ThreadPoolExecutor(max_workers=len(source_names)) as executor:
+        futures = {}
+        for source_name in source_names:
+            logger.info(f'Запускаю получение данных для источника {source_name}')
+            futures[executor.submit(do_source_etl, app_id, source_name)] = source_name
+        # Дожидаемся всех источников: ошибка одного не должна скрывать результат другого
+        failed_sources = []
+        for future in as_completed(futures):
+            source_name = futures[future]
+            try:
+                future.result()
+            except Exception:
+                logger.exception(f'Ошибка при получении данных для источника {source_name}')
+                failed_sources.append(source_name)
+            else:
+                logger.info(f'Успешное получение данных для источника {source_name}')
+    if failed_sources:
+        raise RuntimeError(f'Ошибка при получении данных для источников: {", ".join(failed_sources)}')
+
+def get_source_fields(source_name: str) -> list:
+    all_fields = appmetrica_fields[source_name].split(',')
+    target_columns = client_ch.get_target_columns(source_name)
+    src_fields = [field for field in all_fields if field in target_columns]
+    if not src_fields:
+        logger.warning(f'Не удалось сопоставить поля источника {source_name} со столбцами таблицы, запрашиваю все поля')
+        return all_fields
+    if len(src_fields) < len(all_fields):
+        logger.info(f'Для источника {source_name} запрашивается {len(src_fields)} из {len(all_fields)} полей')
+    return src_fields
 
 def do_source_etl(app_id: int, source_name: str):
     src_max_date = client_ch.get_target_max_date(source_name)
-    src_data = client_am.get_source_data(source_name, app_id, src_max_date)
-    df_src_data = pd.DataFrame(src_data)
-    client_ch.insert_source_data(source_name, df_src_data)
+    src_fields = get_source_fields(source_name)
+    n_rows = 0
+    # Пачки вставляются по мере чтения выгрузки, а следующий запуск начинается с MAX(дата) в таблице.
+    # Выгрузка не упорядочена по дате, поэтому при сбое посреди потока уже вставленные строки
+    # удаляются - иначе недогруженные строки были бы пропущены следующим запуском
+    try:
+        for src_data in client_am.iter_source_data(source_name, app_id, src_max_date, src_fields):
+            client_ch.insert_source_data(source_name, src_data)
+            n_rows += len(next(iter(src_data.values())))
+    except Exception:
+        if n_rows:
+            logger.error(f'Источник {source_name} загружен частично ({n_rows} строк), откатываю загрузку периода после {src_max_date}')
+            try:
+                client_ch.delete_source_data(source_name, app_id, src_max_date)
+            except Exception:
+                logger.exception(f'Не удалось откатить частичную загрузку источника {source_name} '
+                                 f'(приложение {app_id}, период после {src_max_date})')
+        raise
+    if not n_rows:
+        logger.info(f'Нет новых данных для источника {source_name}')
 
 def main():
-    if check_connections():
-        logger.info('Запускаю получение данных из App Metrica')
-        app_id = 4804657
-        logger.info('Запускаю получение данных для приложения NoProblem VPN')
-        do_app_etl(app_id)
-    client_ch.disconnect()
+    client_ch.clear_cache()
+    try:
+        if check_connections():
+            logger.info('Запускаю получение данных из App Metrica')
+            app_id = 4804657
+            logger.info('Запускаю получение данных для приложения NoProblem VPN')
+            do_app_etl(app_id)
+    finally:
+        client_ch.disconnect()
+        client_am.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
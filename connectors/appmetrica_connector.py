@@ -1,12 +1,18 @@
 import requests
+from urllib3.util.retry import Retry
+import ijson
 import logging
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
 import time
-from typing import Union, List, Dict
+from typing import Optional, List, Dict, Iterator
 
 from utils import get_logger
 from config import appmetrica_endpoints, appmetrica_fields
 
+# Размер блока, читаемого из потока ответа при разборе выгрузки
+STREAM_BUFFER_SIZE = 1024 * 1024
+
 
 class AppMetricaConnector:
     """Коннектор для App Metrica"""
@@ -19,15 +25,31 @@ class AppMetricaConnector:
 
         self.logger = get_logger(f"AppMetricaConnector", log_level)
 
-        with requests.Session() as self.session:
-            adapter = requests.adapters.HTTPAdapter(max_retries=20)
-            self.session.mount('https://', adapter)
-            self.session.mount('http://', adapter)
+        # Сессия живет все время работы коннектора: соединение (и TLS-сессия) 
+        # переиспользуется между запросом выгрузки и опросом ее готовности
+        self.session = requests.Session()
+        # Пул рассчитан на параллельную обработку источников, 
+        # временные ошибки сервера повторяются с экспоненциальной задержкой.
+        # Число повторов и задержка ограничены, чтобы один запрос укладывался 
+        # в бюджет ожидания выгрузки (_get_data_from_source, timeout_s)
+        retry = Retry(total=5,
+                      backoff_factor=1.5,
+                      backoff_max=30,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, 
+                                                pool_maxsize=16, 
+                                                max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
         self.headers = {
             'Authorization': 'OAuth ' + self.auth_token
         }
-        self.params = None
+
+    def close(self):
+        """Закрытие HTTP-сессии"""
+        self.session.close()
 
     def test_connection(self) -> bool:
         """Проверка соединения с App Metrica"""
@@ -42,35 +64,66 @@ class AppMetricaConnector:
         
         return test_result
 
-    def get_source_data(self, 
-                        source: str, 
-                        app: str,
-                        date_from: datetime) -> Dict:
+    def iter_source_data(self, 
+                         source: str, 
+                         app: str,
+                         date_from: datetime,
+                         fields: Optional[List[str]] = None,
+                         batch_size: int = 65536) -> Iterator[Dict[str, List]]:
         """
-        Получение актуальных данных из App Metrica
+        Получение актуальных данных из App Metrica пачками по `batch_size` строк
+        Ответ разбирается потоково, данные возвращаются в колоночном виде: {имя поля: список значений}
+        Запрашиваются только поля `fields` (по умолчанию - все поля источника из appmetrica_fields)
+        Ошибки App Metrica приводят к исключению, а не к пустому результату
         """
-        result_data = None
-        if self._request_source_data(source, app, date_from):
-            result_data = self._get_data_from_source()
-            if result_data:
-                result_data = result_data['data']
-        return result_data
+        if not fields:
+            fields = appmetrica_fields[source].split(',')
+        endpoint = appmetrica_endpoints[source]
+        params = self._request_source_data(endpoint, source, app, date_from, fields)
+        if not params:
+            # Период для выгрузки еще не наступил
+            return
+        response = self._get_data_from_source(endpoint, params)
+
+        with response:
+            response.raw.decode_content = True
+            batch = {field: [] for field in fields}
+            n_rows = 0
+            for row in ijson.items(response.raw, 'data.item', buf_size=STREAM_BUFFER_SIZE):
+                for field in fields:
+                    batch[field].append(row.get(field))
+                n_rows += 1
+                if n_rows == batch_size:
+                    yield batch
+                    batch = {field: [] for field in fields}
+                    n_rows = 0
+            if n_rows:
+                yield batch
 
     def _request_source_data(self, 
+                            endpoint: str,
                             source: str, 
                             app: int,
-                            date_from: datetime) -> bool:
+                            date_from: datetime,
+                            fields: List[str]) -> Optional[Dict]:
         """
         Отправка запроса данных в App Metrica
         Запрашиваются данные с `date_from` до конца предыдущего дня
+        Возвращает параметры отправленного запроса (None, если новых данных за период быть не может) - 
+        состояние запроса не хранится в коннекторе, что позволяет выполнять запросы параллельно
         
         :param self: Description
+        :param endpoint: Description
+        :type endpoint: str
         :param source: Description
         :type source: str
         :param app: Description
         :type app: int
         :param date_from: Description
         :type date_from: datetime
+        :param fields: запрашиваемые поля
+        :type fields: List[str]
+        :raises requests.HTTPError: App Metrica отклонила запрос
         """
         
         
@@ -81,60 +134,106 @@ class AppMetricaConnector:
 
         if date_from >= date_until:
             self.logger.warning(f"Новые данные отсуствуют в App Metrica (приложение {app}, тип {source}, период с {date_from} по {date_until})")
-            return False
+            return None
 
         date_from = date_from.strftime('%Y-%m-%d %H:%M:%S')
         date_until = date_until.strftime('%Y-%m-%d %H:%M:%S')
 
-        self.params = {
+        params = {
             'application_id': app,
             'date_since': date_from,
             'date_until': date_until,
-            'fields':appmetrica_fields[source]
+            'fields':','.join(fields)
         }
-        self.data_request_endpoint = appmetrica_endpoints[source]
-        response = self.session.get(self.base_url + self.data_request_endpoint, 
+        response = self.session.get(self.base_url + endpoint, 
                                     headers=self.headers, 
-                                    params=self.params)
+                                    params=params)
         if response.status_code == 202:
             self.logger.info(f"Успешная отправка запроса в App Metrica (приложение {app}, тип {source}, период с {date_from} по {date_until}): {response.text}")
-            return True
+            return params
         elif response.status_code == 200:
             self.logger.warning(f"Запрос с такими параметрами уже был отправлен ранее (приложение {app}, тип {source}, период с {date_from} по {date_until})")
-            return True
+            return params
         else:
-            self.logger.error(f"Ошибка при отправке запроса: {response.status_code=}, {response.text}")
-            return False
+            message = f"Ошибка при отправке запроса: {response.status_code=}, {response.text}"
+            self.logger.error(message)
+            raise requests.HTTPError(message, response=response)
         
     def _get_data_from_source(self, 
-                              n_retries: int = 40, 
-                              wait_s: int = 30) -> Union[bool, List[Dict]]:
+                              endpoint: str,
+                              params: Dict,
+                              timeout_s: float = 1200,
+                              initial_delay_s: float = 2,
+                              max_delay_s: float = 60) -> requests.Response:
         """
-        Ожидаение ответа App Metrica на запрос и возрват его результата
+        Ожидаение ответа App Metrica на запрос и возрват потокового ответа с данными
+        Интервал опроса растет экспоненциально от `initial_delay_s` до `max_delay_s`,
+        заголовок Retry-After (если передан) имеет приоритет
         
         :param self: Description
-        :param n_retries: Description
-        :type n_retries: int
+        :param endpoint: Description
+        :type endpoint: str
+        :param params: Description
+        :type params: Dict
+        :param timeout_s: максимальное время ожидания данных, сек.
+        :type timeout_s: float
+        :param initial_delay_s: начальный интервал опроса, сек.
+        :type initial_delay_s: float
+        :param max_delay_s: максимальный интервал опроса, сек.
+        :type max_delay_s: float
+        :raises TimeoutError: данные не поступили за `timeout_s` сек.
+        :raises requests.HTTPError: App Metrica вернула ошибку
         """
-        if not self.params:
-            self.logger.error(f"Ошибка при ожидании ответа: запрос не был отправлен")
-            return False
-        
-        for i in range(n_retries):
-            response = self.session.get(self.base_url + self.data_request_endpoint, 
+        started_at = time.monotonic()
+        attempt = 0
+        while True:
+            response = self.session.get(self.base_url + endpoint, 
                                         headers=self.headers, 
-                                        params=self.params)
+                                        params=params,
+                                        stream=True)
+            elapsed = time.monotonic() - started_at
             if response.status_code == 202:
-                self.logger.info(f"Ожидание данных от App Metrica {i*wait_s} сек.: {response.text}")
-                time.sleep(wait_s)
+                delay = self._parse_retry_after(response.headers.get('Retry-After'))
+                if delay is None:
+                    delay = min(initial_delay_s * 2 ** attempt, max_delay_s)
+                if elapsed + delay > timeout_s:
+                    message = f'Ошибка при получении данных из App Metrica: данные не поступили за {timeout_s} сек.'
+                    self.logger.error(message)
+                    raise TimeoutError(message)
+                # Тело ответа вычитывается, чтобы соединение вернулось в пул
+                response_text = response.text
+                # На уровне INFO логируется только начало ожидания, каждый опрос - на уровне DEBUG
+                if attempt == 0:
+                    self.logger.info(f"Данные в App Metrica еще готовятся, ожидание до {timeout_s} сек.: {response_text}")
+                self.logger.debug("Ожидание данных от App Metrica %.0f сек.: %s", elapsed, response_text)
+                time.sleep(delay)
+                attempt += 1
                 continue
             elif response.status_code == 200:
-                self.logger.info(f"Успешно получены данные из App Metrica через {i*wait_s}")
-                return response.json()
+                self.logger.info(f"Успешно получены данные из App Metrica через {elapsed:.0f} сек. (опросов: {attempt + 1})")
+                return response
             else:
-                self.logger.error(f"Ошибка при отправке запроса: {response.status_code=}, {response.text}")
-                return False
-        self.logger.error(f'Ошибка при получении данных из App Metrica: данные не поступили за {n_retries * wait_s} сек.')
-        return False
-        
+                message = f"Ошибка при получении данных: {response.status_code=}, {response.text}"
+                self.logger.error(message)
+                raise requests.HTTPError(message, response=response)
 
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """
+        Разбор заголовка Retry-After (число секунд или HTTP-дата)
+        
+        :param value: значение заголовка
+        :type value: Optional[str]
+        :return: задержка в секундах или None, если заголовок отсутствует или некорректен
+        """
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max((retry_at - datetime.now(retry_at.tzinfo)).total_seconds(), 0.0)
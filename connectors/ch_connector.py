@@ -1,13 +1,52 @@
 import pandas as pd
-from typing import Optional, Union, List, Dict
+from datetime import datetime
+from typing import Optional, Union, List, Dict, FrozenSet
 import logging
 import sys
+import pyarrow as pa
+import pyarrow.compute as pc
 import clickhouse_connect
 from clickhouse_connect.driver.client import Client
 
 from utils import get_logger
 from config import appmetrica_ch_tables
 
+# Типы полей App Metrica, требующие преобразования перед вставкой в ClickHouse
+INT_COLUMNS = frozenset({'application_id',
+                         'click_timestamp',
+                         'tracking_id',
+                         'install_receive_timestamp',
+                         'mcc',
+                         'mnc',
+                         'event_receive_timestamp',
+                         'event_timestamp',
+                         'app_build_number'})
+DATETIME_COLUMNS = frozenset({'click_datetime',
+                              'install_datetime',
+                              'install_receive_datetime',
+                              'event_datetime',
+                              'event_receive_datetime'})
+BOOL_COLUMNS = frozenset({'is_reattribution',
+                          'is_reinstallation'})
+# Строковые поля с малым числом уникальных значений
+CATEGORY_COLUMNS = frozenset({'country_iso_code',
+                              'os_name',
+                              'device_type',
+                              'connection_type',
+                              'operator_name',
+                              'device_manufacturer',
+                              'tracker_name',
+                              'publisher_name',
+                              'app_version_name',
+                              'app_package_name'})
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Типы Arrow для полей App Metrica (остальные поля - строки)
+ARROW_TYPES = {
+    **{col: pa.int64() for col in INT_COLUMNS},
+    **{col: pa.timestamp('s') for col in DATETIME_COLUMNS},
+    **{col: pa.bool_() for col in BOOL_COLUMNS},
+}
+
 class ClickHouseConnector:
     """Коннектор для ClickHouse с использованием clickhouse-connect"""
     
@@ -19,7 +58,8 @@ class ClickHouseConnector:
                  secure: bool = True,
                  verify: bool = False,
                  ca_cert='ca_crt',
-                 compress: bool = True,
+                 compress: Union[bool, str] = 'zstd',
+                 async_insert: bool = False,
                  log_level: int = logging.WARNING):
         """
         Инициализация параметров подключения
@@ -32,7 +72,10 @@ class ClickHouseConnector:
             secure: Использовать SSL/TLS
             verify: проверка сертификата
             ca_cert: путь до сертификата
-            compress: Включить сжатие данных
+            compress: Метод сжатия данных при передаче ('zstd', 'lz4', ...), True - выбор метода драйвером, False - без сжатия
+            async_insert: Использовать асинхронные вставки (буферизация на стороне сервера) -
+                          имеет смысл только для частых мелких вставок. По умолчанию False:
+                          данные App Metrica вставляются пачками до 65536 строк синхронно
             log_level: уровень логирования
         """
         self.host = host
@@ -43,8 +86,12 @@ class ClickHouseConnector:
         self.verify = verify
         self.ca_cert = ca_cert
         self.compress = compress
+        self.async_insert = async_insert
         
         self.client: Optional[Client] = None
+        # Кэш результатов запросов в пределах запуска, сброс - метод clear_cache()
+        self._max_date_cache: Dict[tuple, datetime] = {}
+        self._table_columns_cache: Dict[str, FrozenSet[str]] = {}
         self.logger = get_logger(f"ClickHouseConnector.{self.host}", log_level)
         
     def connect(self) -> bool:
@@ -63,7 +110,9 @@ class ClickHouseConnector:
                 secure=self.secure,
                 verify=self.verify,
                 ca_cert=self.ca_cert,
-                compress=self.compress
+                compress=self.compress,
+                # без сессии клиент можно использовать из нескольких потоков одновременно
+                autogenerate_session_id=False
             )
             
             # Проверяем подключение
@@ -115,13 +164,18 @@ class ClickHouseConnector:
             self.logger.error(f"Ошибка выполнения запроса {query=}: {e}")
             raise
     
-    def get_target_max_date(self, target: str):
+    def get_target_max_date(self, target: str, lookback_days: int = 60):
         """
         Получение максимальной даты данных в источнике (installations или events)
         Необходмо для последующего запроса актуальных данных из App Metrica 
+        Сначала просматриваются только последние `lookback_days` дней (читаются только свежие части таблицы),
+        если за этот период данных нет - выполняется поиск по всей таблице
+        Результат кэшируется до следующей вставки в таблицу (или до вызова clear_cache())
+        Дата считается по всей таблице, без учета application_id
 
         Args:
             target: источник (installations или events)
+            lookback_days: глубина поиска максимальной даты, дней
 
         Returns:
             Дата в формате datetime.datetime
@@ -129,110 +183,260 @@ class ClickHouseConnector:
         """
         target_table = appmetrica_ch_tables[target]['table_name']
         date_time_field = appmetrica_ch_tables[target]['date_time_field']
+        cache_key = (target_table, date_time_field, lookback_days)
+        if cache_key not in self._max_date_cache:
+            self._max_date_cache[cache_key] = self._get_table_max_date(target_table, date_time_field, lookback_days)
+        return self._max_date_cache[cache_key]
+
+    def _get_table_max_date(self, 
+                            target_table: str, 
+                            date_time_field: str, 
+                            lookback_days: int) -> datetime:
+        """
+        Получение максимальной даты в таблице ClickHouse
+
+        Args:
+            target_table: Имя таблицы
+            date_time_field: поле с датой
+            lookback_days: глубина поиска максимальной даты, дней
 
+        Returns:
+            Дата в формате datetime.datetime
+        """
         target_max_date_sql = f"""
-                SELECT MAX({date_time_field})
+                SELECT maxOrNull({date_time_field})
                 FROM {target_table}
+                WHERE {date_time_field} > now() - INTERVAL {int(lookback_days)} DAY
             """
-        self.logger.info(f"Получаю MAX {date_time_field} из таблицы {target_table}")
-        sql_res = self.execute_query(target_max_date_sql, return_df=False)
-        max_date = list(sql_res[0].values())[0]
-        max_date = max_date.replace(tzinfo=None)
+        self.logger.info(f"Получаю MAX {date_time_field} из таблицы {target_table} за последние {lookback_days} дней")
+        max_date = self._query_max_date(target_max_date_sql)
+        # maxOrNull по пустой выборке возвращает NULL (MAX вернул бы начало эпохи в часовом поясе сервера)
+        if max_date is None:
+            target_max_date_sql = f"""
+                    SELECT MAX({date_time_field})
+                    FROM {target_table}
+                """
+            self.logger.info(f"Данные за последние {lookback_days} дней отсутствуют, получаю MAX {date_time_field} из всей таблицы {target_table}")
+            max_date = self._query_max_date(target_max_date_sql)
         self.logger.info(f"MAX {date_time_field} из таблицы {target_table}: {max_date.strftime('%Y-%m-%d %H:%M:%S')}")
         return max_date
 
+    def get_target_columns(self, target: str) -> FrozenSet[str]:
+        """
+        Получение списка столбцов целевой таблицы источника (installations или events)
+        Необходимо, чтобы запрашивать из App Metrica только поля, которые есть в таблице
+        Результат кэшируется в пределах запуска, сброс кэша - метод clear_cache()
+
+        Args:
+            target: источник (installations или events)
+
+        Returns:
+            Множество имен столбцов таблицы
+        """
+        target_table = appmetrica_ch_tables[target]['table_name']
+        if target_table not in self._table_columns_cache:
+            self._table_columns_cache[target_table] = self._get_table_columns(target_table)
+        return self._table_columns_cache[target_table]
+
+    def _get_table_columns(self, target_table: str) -> FrozenSet[str]:
+        """
+        Получение имен столбцов таблицы ClickHouse из system.columns
+
+        Args:
+            target_table: Имя таблицы в формате database.table
+
+        Returns:
+            Множество имен столбцов таблицы
+        """
+        database, table = target_table.split('.', 1)
+        table_columns_sql = f"""
+                SELECT name
+                FROM system.columns
+                WHERE database = '{database}' AND table = '{table}'
+            """
+        self.logger.info(f"Получаю список столбцов таблицы {target_table}")
+        sql_res = self.execute_query(table_columns_sql, return_df=False)
+        return frozenset(row['name'] for row in sql_res)
+
+    def clear_cache(self):
+        """Сброс кэшированных результатов запросов к ClickHouse"""
+        self._max_date_cache.clear()
+        self._table_columns_cache.clear()
+
+    def _invalidate_max_date(self, target_table: str):
+        """
+        Сброс кэшированной максимальной даты таблицы после изменения ее данных
+        
+        Args:
+            target_table: Имя таблицы
+        """
+        for cache_key in [key for key in self._max_date_cache if key[0] == target_table]:
+            self._max_date_cache.pop(cache_key, None)
+
+    def _query_max_date(self, query: str) -> Optional[datetime]:
+        """
+        Выполнение запроса MAX(дата) и приведение результата к datetime без часового пояса
+        
+        Args:
+            query: SQL запрос, возвращающий одно значение даты
+
+        Returns:
+            Дата в формате datetime.datetime или None, если запрос вернул NULL
+        """
+        sql_res = self.execute_query(query, return_df=False)
+        max_date = list(sql_res[0].values())[0]
+        if max_date is None:
+            return None
+        return max_date.replace(tzinfo=None)
+
     def insert_source_data(self,
                            source_name: str,
-                           df: pd.DataFrame,
+                           columns: Optional[Dict[str, List]],
                          ):
         """
-        Docstring for insert_source_data
+        Вставка данных источника App Metrica в целевую таблицу ClickHouse
         
-        :param self: Description
-        :param source_name: Description
-        :type source_name: str
-        :param df: Description
-        :type df: pd.DataFrame
+        Args:
+            source_name: источник (installations или events)
+            columns: данные в колоночном виде {имя поля: список значений}
         """
         table_name = appmetrica_ch_tables[source_name]['table_name']
-        self.insert_dataframe(table_name, df)
+        self.insert_columns(table_name, columns)
+        self._invalidate_max_date(table_name)
         return
 
-    def insert_dataframe(self, 
-                         table_name: str, 
-                         df: pd.DataFrame,
-                         ):
+    def delete_source_data(self,
+                           source_name: str,
+                           app_id: int,
+                           date_from: datetime,
+                           ):
         """
-        Вставка данных из DataFrame в таблицу ClickHouse
+        Удаление данных приложения, загруженных после `date_from` 
+        Используется для отката частично загруженной выгрузки, чтобы следующий запуск загрузил период заново
+        
+        Args:
+            source_name: источник (installations или events)
+            app_id: id приложения App Metrica
+            date_from: дата, после которой данные удаляются (не включительно)
+        """
+        if not self.client:
+            raise ConnectionError("Сначала выполните подключение через метод connect()")
+        
+        table_name = appmetrica_ch_tables[source_name]['table_name']
+        date_time_field = appmetrica_ch_tables[source_name]['date_time_field']
+        delete_sql = f"""
+                ALTER TABLE {table_name}
+                DELETE WHERE application_id = {int(app_id)}
+                    AND {date_time_field} > '{date_from.strftime(DATETIME_FORMAT)}'
+            """
+        try:
+            # mutations_sync=2 - дожидаемся выполнения удаления на всех репликах
+            self.client.command(delete_sql, settings={'mutations_sync': 2})
+            self._invalidate_max_date(table_name)
+            self.logger.info(f"Удалены данные приложения {app_id} с {date_time_field} > {date_from} из таблицы {table_name}")
+        except Exception as e:
+            self.logger.error(f"Ошибка удаления данных из таблицы {table_name}: {e}")
+            raise
+
+    def insert_columns(self,
+                       table_name: str,
+                       columns: Optional[Dict[str, List]],
+                       ):
+        """
+        Вставка колоночных данных в таблицу ClickHouse в формате Arrow без промежуточного DataFrame
         
         Args:
             table_name: Имя таблицы
-            df: DataFrame с данными
+            columns: данные в колоночном виде {имя поля: список значений}
         """
         if not self.client:
             raise ConnectionError("Сначала выполните подключение через метод connect()")
         
-        if df.empty:
-            self.logger.warning("DataFrame пуст, вставка не требуется")
+        n_rows = len(next(iter(columns.values()), [])) if columns else 0
+        if n_rows == 0:
+            self.logger.warning("Данные для вставки отсутствуют, вставка не требуется")
             return
         
         try:
             # Подготовка данных - обработка типов
-            df_prepared = self._prepare_dataframe(df)
+            arrow_table = self._prepare_arrow_table(columns)
             
             # Вставляем данные
-            self.client.insert_df(table=table_name, 
-                                  df=df_prepared
-                                  )
+            self.client.insert_arrow(table=table_name,
+                                     arrow_table=arrow_table,
+                                     settings=self._get_insert_settings()
+                                     )
             
-            self.logger.info(f"Успешно вставлено {len(df)} строк в таблицу {table_name}")
+            self.logger.info(f"Успешно вставлено {n_rows} строк в таблицу {table_name}")
             
         except Exception as e:
             self.logger.error(f"Ошибка вставки данных в таблицу {table_name}: {e}")
             raise
+
+    def _get_insert_settings(self) -> Dict:
+        """
+        Настройки ClickHouse для вставки данных
+        
+        Returns:
+            Словарь настроек для client.insert_arrow
+        """
+        if not self.async_insert:
+            return {}
+        # Ждем записи буфера на сервере: иначе ошибка вставки теряется, 
+        # а следующий запуск начнется с MAX(дата) уже после пропуска
+        return {
+            'async_insert': 1,
+            'wait_for_async_insert': 1,
+            'async_insert_busy_timeout_ms': 10000
+        }
     
-    def _prepare_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
+    def _prepare_arrow_table(self, columns: Dict[str, List]) -> pa.Table:
         """
-        Подготовка DataFrame для вставки в ClickHouse 
-                -- преобразование типов в соответствии с целевой таблицей Clickhouse
+        Подготовка колоночных данных для вставки в ClickHouse 
+                -- преобразование типов в соответствии с целевой таблицей Clickhouse (ARROW_TYPES)
         
         Args:
-            df: Исходный DataFrame
+            columns: Исходные данные {имя поля: список значений}
             
         Returns:
-            Подготовленный DataFrame
-        """
-        df_prepared = df.copy()
-        
-        int_columns = ['application_id', 
-                       'click_timestamp',
-                       'tracking_id',
-                       'install_receive_timestamp',
-                       'mcc',
-                       'mnc',
-                       'event_receive_timestamp',
-                       'event_timestamp',
-                       'app_build_number']
-        datetime_columns = ['click_datetime',
-                            'install_datetime',
-                            'install_receive_datetime',
-                            'event_datetime',
-                            'event_receive_datetime']
-        bool_columns = ['is_reattribution', 
-                        'is_reinstallation']
-
-        for col in df_prepared.columns:
-            if col in int_columns:
-                df_prepared[col] = df_prepared[col].astype(int)
-            elif col in datetime_columns:
-                df_prepared[col] = pd.to_datetime(df_prepared[col], format='%Y-%m-%d %H:%M:%S')
-            elif col in bool_columns:
-                df_prepared[col] = df_prepared[col].map({
-                                    'true': 1,
-                                    'false': 0
-                                }).fillna(0).astype(bool)
-        
-        return df_prepared
+            Таблица Arrow
+        """
+        arrays = []
+        for col, values in columns.items():
+            arrow_type = ARROW_TYPES.get(col, pa.string())
+            if pa.types.is_timestamp(arrow_type):
+                array = self._empty_to_null(pa.array(values, type=pa.string()))
+                # Значения дат сильно повторяются - разбираем только уникальные и сопоставляем обратно
+                encoded = array.dictionary_encode()
+                parsed = pc.strptime(encoded.dictionary, format=DATETIME_FORMAT, unit='s')
+                array = pc.take(parsed, encoded.indices)
+            elif pa.types.is_boolean(arrow_type):
+                array = pc.fill_null(pc.equal(pa.array(values, type=pa.string()), 'true'), False)
+            elif pa.types.is_integer(arrow_type):
+                array = self._empty_to_null(pa.array(values)).cast(arrow_type)
+            else:
+                array = pa.array(values).cast(arrow_type)
+            if col in CATEGORY_COLUMNS:
+                # Словарное кодирование: соответствует LowCardinality(String) в ClickHouse
+                array = array.dictionary_encode()
+            arrays.append(array)
+        
+        return pa.table(arrays, names=list(columns.keys()))
+    
+    @staticmethod
+    def _empty_to_null(array: pa.Array) -> pa.Array:
+        """
+        Замена пустых строк на NULL - App Metrica передает '' для отсутствующих значений
+        
+        Args:
+            array: Массив Arrow
+            
+        Returns:
+            Массив Arrow без пустых строк (нестроковые массивы возвращаются без изменений)
+        """
+        if not pa.types.is_string(array.type):
+            return array
+        return pc.if_else(pc.equal(array, ''), pa.scalar(None, type=array.type), array)
     
     def test_connection(self) -> bool:
         """Проверка соединения с ClickHouse"""